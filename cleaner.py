@@ -1,5 +1,38 @@
+import collections
+import copy
+import functools
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import dax
-import pandas
+
+
+RENAME_TABLE = 'scan_type_renames.csv'
+UNUSABLE_PATTERN = re.compile('inc|bad|incomplete|unusable', re.IGNORECASE)
+
+SubjectMeta = collections.namedtuple('SubjectMeta', 'project nsessions session_date '
+                                     'session_id session_label subject_id')
+
+_interfaces = {}
+
+
+def _get_interface(host=None, user=None):
+    "Return a shared XNAT interface for (host, user), authenticating only on first use."
+    key = (host, user)
+    if key not in _interfaces:
+        _interfaces[key] = dax.XnatUtils.get_interface(host=host, user=user)
+    return _interfaces[key]
+
+
+def close_interfaces():
+    """Disconnect and forget every shared XNAT interface. Subjects created without an
+    explicit interface open a new shared one on their next request; interfaces passed
+    in explicitly are left untouched."""
+    for xnat in _interfaces.values():
+        xnat.disconnect()
+    _interfaces.clear()
 
 
 class XnatSubject:
@@ -9,71 +42,289 @@ class XnatSubject:
     
     Attributes:
         subject: XNAT subject_label (e.g. LD4001_v1)
-        meta: metadata dictionary associated with subject
         database: XNAT project (e.g. CUTTING)
-        interface: `dax.XnatUtils` interface instance
-        sess_df: Pandas DataFrame showing all subject sessions
+        project: Study prefix of the subject label (e.g. LD4)
+        interface: `dax.XnatUtils` interface instance (the shared interface if none given)
+        xnat_object: pyxnat subject object
+        meta: `SubjectMeta` tuple of metadata associated with subject
+        session_data: List of session dictionaries returned by XNAT
         scan_df: Pandas DataFrame showing all subject scans
+        session_df: Pandas DataFrame showing all subject sessions
+        scan_renames: Suggested scan type changes (computed on first access)
+        log: Results of the scan checks (computed on first access)
+
+    With evaluate=False, the scan rename and check steps are skipped at init.
 
     Methods:
-        get_metadata(): Extract session and scan DataFrames.
+        for_subjects(), bulk_from_project(), bulk_search(): Build many subjects at once,
+            returning `(subjects, errors)`.
+        get_metadata(): Extract session and scan DataFrames (cached after first call).
         match_scan_types(): Checks `scan_type_renames.csv` for suggested name changes.
-        update_scan_types(): Applies scan type updates to XNAT scans.       
+        update_scan_types(): Applies scan type updates to XNAT scans.
+        run_test_functions(): Checks for duplicate and unusable scans.
+        update_unusable_scans(): Renames scans tagged as unusable or incomplete.
+        print_summary(): Prints the metadata, suggested renames and check results.
     """    
+    __slots__ = ('subject', 'database', 'project', '_interface', '_xnat_object',
+                 '_xnat_interface', '_session_data', '_scan_df', '_meta', '_scan_renames', '_log')
+
     def __init__(self, subject_label, database='CUTTING', xnat=None, 
-                 print_summary=False):
-        "Initialize subject and connections to XNAT."
+                 print_summary=False, evaluate=True):
+        """Initialize subject and connections to XNAT. The XNAT interface, subject
+        object and metadata are only fetched when first needed, so with evaluate=False
+        no requests are made until an attribute that needs XNAT is accessed."""
         
         self.subject = subject_label
         self.database = database
+        self.project = subject_label[0:3]  # EBRL study code, e.g. LD4 for LD4001_v1
+        self._interface = xnat
+        self._xnat_object = None
+        self._xnat_interface = None
+        self._session_data = None
+        self._scan_renames = None
+        self._log = None
         
-        # Create XNAT interface if not provided
-        if xnat is None:
-            xnat = dax.XnatUtils.get_interface()
-        self.interface = xnat
-        
-        # Select XNAT object
-        self.xnat_object = xnat.select.project(database).subject(subject_label)
-        
-        # Gather metadata and evaluate subject
-        self.get_metadata()
-        self.match_scan_types()
-        self.run_test_functions()
+        # Evaluate subject (pulls metadata from XNAT); otherwise this runs on first use
+        if evaluate:
+            self.match_scan_types()
+            self.run_test_functions()
 
         # Print summary if requested
-        if print_summary == True:
+        if print_summary:
             self.print_summary()
 
+
+    @classmethod
+    def for_subjects(cls, subject_labels, database='CUTTING', xnat=None, evaluate=True):
+        """Initialize several subjects that share one XNAT interface and rename table.
+        Returns (subjects, errors) as described in `bulk_from_project`."""
+        cls._load_rename_table()
+
+        return cls._build_subjects(subject_labels, database, xnat, evaluate,
+                                   lambda subject: subject.get_metadata())
+
+
+    @classmethod
+    def bulk_from_project(cls, project='CUTTING', subject_labels=None, xnat=None,
+                          evaluate=True, prefetch_scans=False):
+        """Initialize subjects from a single project-wide session query, instead of one
+        `list_sessions` request per subject. If subject_labels is None, every subject
+        with a session in the project is returned. With prefetch_scans=True, scans are
+        also listed for the whole project in one request rather than per subject.
+
+        Returns (subjects, errors): subjects that could not be loaded (e.g. no sessions
+        or several sessions) are skipped and their ValueError stored in errors by label."""
+        intf = _get_interface() if xnat is None else xnat
+        sessions = dax.XnatUtils.list_sessions(intf, project)
+        return cls._from_sessions(sessions, project, subject_labels, xnat, evaluate,
+                                  prefetch_scans)
+
+
+    @classmethod
+    def bulk_search(cls, project='CUTTING', subject_labels=None, xnat=None,
+                    evaluate=True, prefetch_scans=False):
+        """Initialize subjects from one server-side XNAT search over image sessions (all
+        modalities, as `list_sessions` returns), which returns only the session fields
+        XnatSubject needs. If subject_labels is given, the search is restricted to those
+        subjects. prefetch_scans and the (subjects, errors) return value are as in
+        `bulk_from_project`."""
+        if subject_labels is not None:
+            subject_labels = list(subject_labels)
+            if not subject_labels:
+                return [], {}
+        intf = _get_interface() if xnat is None else xnat
+
+        # Build the search constraints
+        criteria = [('xnat:imageSessionData/PROJECT', '=', project)]
+        if subject_labels is not None:
+            criteria.append([('xnat:imageSessionData/SUBJECT_LABEL', '=', label)
+                             for label in subject_labels] + ['OR'])
+        criteria.append('AND')
+
+        columns = ['xnat:imageSessionData/' + c for c in
+                   ('SESSION_ID', 'LABEL', 'DATE', 'SUBJECT_ID', 'SUBJECT_LABEL')]
+        table = intf.select('xnat:imageSessionData', columns).where(criteria)
+
+        # Rename the search columns to the keys returned by `list_sessions`
+        sessions = [{'ID': row['session_id'],
+                     'label': row['label'],
+                     'date': row['date'],
+                     'subject_ID': row['subject_id'],
+                     'subject_label': row['subject_label']}
+                    for row in table.data]
+        return cls._from_sessions(sessions, project, subject_labels, xnat, evaluate,
+                                  prefetch_scans)
+
+
+    @classmethod
+    def _from_sessions(cls, sessions, project, subject_labels, xnat, evaluate,
+                       prefetch_scans):
+        """Initialize subjects from already-fetched session rows, grouped by subject_label.
+        Returns (subjects, errors) as described in `bulk_from_project`."""
+        sessions_by_subject = {}
+        for sess in sessions:
+            sessions_by_subject.setdefault(sess['subject_label'], []).append(sess)
+        if subject_labels is None:
+            subject_labels = sorted(sessions_by_subject)
+
+        # Optionally list every scan in the project at once, grouped by session
+        scans_by_session = None
+        if prefetch_scans:
+            scans_by_session = {}
+            intf = _get_interface() if xnat is None else xnat
+            for scan in dax.XnatUtils.list_project_scans(intf, project):
+                scans_by_session.setdefault(scan['session_label'], []).append(scan)
+
+        def load(subject):
+            subject._load_metadata(sessions_by_subject.get(subject.subject, []),
+                                   scans_by_session)
+
+        return cls._build_subjects(subject_labels, project, xnat, evaluate, load)
+
+
+    @classmethod
+    def _build_subjects(cls, subject_labels, database, xnat, evaluate, load):
+        """Initialize a subject per label and fill its metadata with load(subject),
+        setting aside those that fail the session checks. Returns (subjects, errors)."""
+        subjects, errors = [], {}
+        for label in subject_labels:
+            subject = cls(label, database=database, xnat=xnat, evaluate=False)
+            try:
+                load(subject)
+            except ValueError as e:
+                errors[label] = e
+                continue
+            if evaluate:
+                subject.match_scan_types()
+                subject.run_test_functions()
+            subjects.append(subject)
+
+        return subjects, errors
+
         
-    def get_metadata(self):
-        "Return information about the subject's sessions and scans."
+    @property
+    def interface(self):
+        """`dax.XnatUtils` interface. If none was provided, the shared interface is looked
+        up on each access, so subjects reconnect after `close_interfaces()`."""
+        if self._interface is None:
+            return _get_interface()
+        return self._interface
+
+
+    @interface.setter
+    def interface(self, xnat):
+        "Switch the subject to another interface (None selects the shared interface)."
+        self._interface = xnat
+
+
+    @property
+    def xnat_object(self):
+        "XNAT subject object, selected on first access (and again if the interface changes)."
+        interface = self.interface
+        if self._xnat_object is None or self._xnat_interface is not interface:
+            self._xnat_object = interface.select.project(self.database).subject(self.subject)
+            self._xnat_interface = interface
+        return self._xnat_object
+
+
+    def get_metadata(self, force=False):
+        """Return information about the subject's sessions and scans. Metadata is
+        fetched from XNAT once and cached; pass force=True to re-fetch it, bypassing
+        any request cache set up with `enable_cache`."""
+        if force:
+            _invalidate_cache(self.interface, '/subjects/{}/'.format(self.subject))
+        if force or self._session_data is None:
+            self._fetch_metadata()
+        return self._meta
+
+
+    @property
+    def meta(self):
+        "`SubjectMeta` tuple associated with subject; use `meta._asdict()` for a dict."
+        return self.get_metadata()
+
+
+    @property
+    def session_data(self):
+        "List of session dictionaries returned by XNAT."
+        self.get_metadata()
+        return self._session_data
+
+
+    @property
+    def scan_df(self):
+        "Pandas DataFrame showing all subject scans."
+        self.get_metadata()
+        return self._scan_df
+
+
+    def _fetch_metadata(self):
+        "Pull information about the subject's sessions and scans from XNAT."
         
         # Get data on the individual session
         session_data = dax.XnatUtils.list_sessions(self.interface, 
                                                    self.database, 
                                                    self.subject)
-        sess_df = pandas.DataFrame(session_data)
+        self._load_metadata(session_data)
+
+
+    def _load_metadata(self, session_data, scans_by_session=None):
+        """Store the subject's session data and its scans, which are pulled from XNAT
+        unless already listed in scans_by_session (keyed by session label). Sessions
+        missing from scans_by_session are listed individually."""
+        import pandas
+
+        # Throw error unless there is exactly one session available
+        if not session_data:
+            raise ValueError('This subject has no sessions in XNAT.')
+        if len(session_data) > 1:
+            raise ValueError('This subject has too many sessions in XNAT. Please combine them.')
         
-        # Get data on each individual scan
-        scan_data = []
-        for ii, sess in sess_df.iterrows():
-            scan_data += dax.XnatUtils.list_scans(self.interface, 
-                             self.database, self.subject, sess['label'])
+        # Get data on each individual scan in the (single) session
+        sess, = session_data
+        if scans_by_session is not None and sess['label'] in scans_by_session:
+            scan_data = scans_by_session[sess['label']]
+        else:
+            scan_data = dax.XnatUtils.list_scans(self.interface, self.database,
+                                                 self.subject, sess['label'])
         scan_df = pandas.DataFrame(scan_data)
-        
-        # Throw error if there is more than one session available
-        if len(session_data) != 1:
-            raise ValueError('This subject has too many sessions in XNAT. Please combine them.')
 
-        self.meta = {'project': self.subject[0:3],
-                     'nsessions': len(session_data),
-                     'session_date': sess_df['date'].tolist(), 
-                     'session_id': sess_df['ID'].tolist(),
-                     'session_label': sess_df['label'].tolist(),
-                     'subject_id': sess_df['subject_ID'].tolist()
-                    }
-        self.session_df = sess_df
-        self.scan_df = scan_df
+        # Scan names repeat heavily across scans, so store them as categoricals
+        for col in ('scan_type', 'series_description'):
+            if col in scan_df:
+                scan_df[col] = scan_df[col].astype('category')
+
+        self._meta = SubjectMeta(project=self.project,
+                                 nsessions=len(session_data),
+                                 session_date=[sess['date']],
+                                 session_id=[sess['ID']],
+                                 session_label=[sess['label']],
+                                 subject_id=[sess['subject_ID']])
+        self._scan_df = scan_df
+        self._session_data = session_data
+
+
+    @property
+    def scan_renames(self):
+        "Dictionary of suggested scan type renames, matched on first access."
+        if self._scan_renames is None:
+            self.match_scan_types()
+        return self._scan_renames
+
+
+    @property
+    def log(self):
+        "Dictionary of scan check results, computed on first access."
+        if self._log is None:
+            self.run_test_functions()
+        return self._log
+
+
+    @property
+    def session_df(self):
+        "Pandas DataFrame of the subject's sessions, built on demand."
+        import pandas
+        return pandas.DataFrame(self.session_data)
 
 
     def update_scan_types(self, overwrite=False):
@@ -82,16 +333,19 @@ class XnatSubject:
         this function will update each object on XNAT with the suggested
         scan type rename. If False, it will simply print the suggested renames.
         """
+        # Nothing to do (or index) if no scans matched a rename
+        if not self.scan_renames:
+            return
+
         # loop through each item in the matched scan types and rename
-        for scan_id, new_type in self.scan_renames.iteritems():
-            s  = self.scan_df.loc[self.scan_df.ID == scan_id].iloc[0]
-            obj = (self.interface.select.project('CUTTING')
-                       .subject(s.subject_label)
-                       .experiment(s.session_label)
-                       .scan(scan_id) )
+        experiment = self.xnat_object.experiment(self.meta.session_label[0])
+        scans_by_id = self.scan_df.drop_duplicates('ID').set_index('ID', drop=False)
+        for scan_id, new_type in self.scan_renames.items():
+            s = scans_by_id.loc[scan_id]
+            obj = experiment.scan(scan_id)
                     
             # Update the attribute on XNAT, if overwrite is selected
-            if overwrite == True:
+            if overwrite:
                 obj.attrs.set('type', new_type)
                 print('Updated {} ({}, {}) to new scan type: {}'.format(scan_id, 
                                       s.series_description, s.scan_type, new_type))
@@ -101,9 +355,9 @@ class XnatSubject:
                 print('Suggested scan rename: {} ({}, {}) to {}.'.format(scan_id, 
                                       s.series_description, s.scan_type, new_type))
 
-        # If scans updated, refresh the scan metadata and scan_type matches
-        if overwrite == True:
-            self.get_metadata()
+        # If scans updated, refresh the scan metadata and scan_type matches once
+        if overwrite:
+            self.get_metadata(force=True)
             self.match_scan_types()
 
                 
@@ -115,25 +369,41 @@ class XnatSubject:
         
         # Initialize dictionary of scan_renames
         rename_dict = self.get_scan_rename_dict()
-        self.scan_renames = {}
+        self._scan_renames = {}
+        if self.scan_df.empty:
+            return
 
-        for _, scan in self.scan_df.iterrows():
-            scan_tuple = (scan.series_description, scan.scan_type)
-            if scan_tuple in rename_dict.keys():
-                self.scan_renames[scan.ID] = rename_dict[scan_tuple]
+        # Look up every (series_description, scan_type) pair from the raw column arrays;
+        # at per-subject scan counts this beats building a MultiIndex and mapping it
+        ids, descriptions, types = (self.scan_df[c].values for c in
+                                    ('ID', 'series_description', 'scan_type'))
+        self._scan_renames = {i: rename_dict[(d, t)]
+                              for i, d, t in zip(ids, descriptions, types)
+                              if (d, t) in rename_dict}
 
                 
     def get_scan_rename_dict(self):
         """Generate a dictionary of (series_description, scan_type) pairs that encode a 
         valid renaming instance. Top-level dicionary is indexed by EBRL project."""
 
-        df = pandas.read_csv('scan_type_renames.csv')
+        return self._load_rename_table().get(self.project, {})
 
-        rename_dict = {}
-        for ii, s in df.loc[df.project == self.meta['project']].iterrows():
-            rename_dict[(s.series_description, s.scan_type)] = s.updated_scan_type
 
-        return rename_dict       
+    @classmethod
+    def _load_rename_table(cls):
+        "Return the parsed rename table, re-reading the CSV only if it has changed."
+        return cls._read_rename_table(os.path.getmtime(RENAME_TABLE))
+
+
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _read_rename_table(mtime):
+        "Parse the rename table into per-project dictionaries. Cached on file mtime."
+        import pandas
+        df = pandas.read_csv(RENAME_TABLE)
+        return {project: dict(zip(zip(g.series_description, g.scan_type),
+                                  g.updated_scan_type))
+                for project, g in df.groupby('project')}
         
         
     def run_test_functions(self):
@@ -146,45 +416,50 @@ class XnatSubject:
             Check if the scan quality is consistent with expectations (e.g. same amount of frames)
         """
 
-        self.log = {}         
-        self.check_duplicate_scans()
-        self.check_unusable_scans()
+        self._log = {}
+        self._run_checks()
+
+
+    def _run_checks(self):
+        "Run the duplicate and unusable scan checks off a single read of scan_type."
+        scan_type = self.scan_df.get('scan_type')
+        self._log_scans('duplicate_scans', scan_type, self._duplicate_mask)
+        self._log_scans('unusable_scans', scan_type, self._unusable_mask)
     
     
     def check_duplicate_scans(self):
         "Check for duplicate scan names that are not allowable (i.e. not 'Incomplete')."
-        duplicates = self.scan_df.loc[self.scan_df.scan_type.duplicated()]
-
-        try: 
-            assert duplicates.shape[0] == 0
-            self.log['duplicate_scans'] = None
-        except AssertionError:
-            cols = ['ID', 'subject_label', 'session_label', 'scan_type']
-            self.log['duplicate_scans'] = duplicates[cols].to_records()
+        self._log_scans('duplicate_scans', self.scan_df.get('scan_type'), self._duplicate_mask)
 
         
     def check_unusable_scans(self):
         "Check for scans tagged with 'Incomplete' or 'Unusable'."
-        
-        # Select rows from scan_df with unusable scans
-        def evaluate_type(scan_type):
-            if scan_type == 'Unusable':
-                return False         
-            
-            bad_strings = ['inc', 'bad', 'incomplete', 'unusable']
-            if any(s in scan_type.lower() for s in bad_strings):
-                return True
-            else:
-                return False
-        
-        unusables = self.scan_df.loc[self.scan_df.scan_type.apply(evaluate_type)]
+        self._log_scans('unusable_scans', self.scan_df.get('scan_type'), self._unusable_mask)
 
-        try:
-            assert unusables.shape[0] == 0
-            self.log['unusable_scans'] = None
-        except AssertionError:
-            cols = ['ID', 'subject_label', 'session_label', 'scan_type']
-            self.log['unusable_scans'] = unusables[cols].to_records()
+
+    @staticmethod
+    def _duplicate_mask(scan_type):
+        "Flag every repeat of a scan type after its first occurrence."
+        return scan_type.duplicated()
+
+
+    @staticmethod
+    def _unusable_mask(scan_type):
+        "Flag unusable scan types (scans already tagged 'Unusable' are excluded)."
+        return (scan_type.str.contains(UNUSABLE_PATTERN, na=False)
+                & (scan_type != 'Unusable'))
+
+
+    def _log_scans(self, key, scan_type, make_mask):
+        """Record the scans flagged by make_mask(scan_type) under self.log[key], or None
+        if there are none (including subjects without any scans)."""
+        if self.scan_df.empty:
+            self.log[key] = None
+            return
+
+        flagged = self.scan_df.loc[make_mask(scan_type)]
+        cols = ['ID', 'subject_label', 'session_label', 'scan_type']
+        self.log[key] = flagged[cols].to_records() if flagged.shape[0] else None
 
 
     def update_unusable_scans(self, overwrite = False):
@@ -197,14 +472,12 @@ class XnatSubject:
             return
         
         # Loop through scans and update if requested
+        experiment = self.xnat_object.experiment(self.meta.session_label[0])
         for scan in unusables:
-            obj = (self.interface.select.project('CUTTING')
-                       .subject(scan['subject_label'])
-                       .experiment(scan['session_label'])
-                       .scan(scan['ID']) )
+            obj = experiment.scan(scan['ID'])
                     
             # Update the attribute on XNAT, if overwrite is selected
-            if overwrite == True:
+            if overwrite:
                 obj.attrs.set('type', 'Unusable')
                 print('Updated {} ({}) to Unusable'.format(scan['ID'], scan['scan_type']))
             
@@ -214,8 +487,8 @@ class XnatSubject:
                          .format(scan['ID'], scan['scan_type']) )
 
         # Refresh the scan metadata and scan_type matches
-        if overwrite == True:
-            self.get_metadata()
+        if overwrite:
+            self.get_metadata(force=True)
             self.check_unusable_scans()
 
             
@@ -224,27 +497,142 @@ class XnatSubject:
         
         # Print subject information
         print('Subject ID: {}'.format(self.subject))
-        print('Project: {}'.format(self.meta['project']))
-        print('Session(s): {}'.format(','.join(self.meta['session_label'])))
-        print('Session date(s): {}'.format(','.join(self.meta['session_date'])))
+        print('Project: {}'.format(self.meta.project))
+        print('Session(s): {}'.format(','.join(self.meta.session_label)))
+        print('Session date(s): {}'.format(','.join(self.meta.session_date)))
                
         # Print the proposed scan renames
         self.update_scan_types(overwrite=False)
         
-        # Print any duplicate scans
-        try:
-            d = self.log['duplicate_scans']
-            s = '\n\t'.join('{}, {}'.format(str(a), str(b)) for a, b 
-                             in d[['ID', 'scan_type']].tolist())
-            print('Duplicate scans:\n\t{}'.format(s))
-        except:
-            print('Duplicate scans: None')
-            
-        # Print any Unusable scans
+        # Print any duplicate and Unusable scans
+        self._print_scan_log('Duplicate scans', self.log['duplicate_scans'])
+        self._print_scan_log('Unflagged unusable scans', self.log['unusable_scans'])
+
+
+    @staticmethod
+    def _print_scan_log(title, scans):
+        "Print the ID and scan type of each record in a scan log entry."
+        if scans is None:
+            print('{}: None'.format(title))
+            return
+
+        s = '\n\t'.join('{}, {}'.format(scan['ID'], scan['scan_type']) for scan in scans)
+        print('{}:\n\t{}'.format(title, s))
+
+
+def gather_metadata(subject_labels, database='CUTTING', xnat=None, max_workers=8):
+    """Fetch metadata for many subjects concurrently. Returns (subjects, errors): a
+    dictionary of (unevaluated) XnatSubject instances keyed by subject label, and a
+    dictionary of the ValueError raised for each subject that could not be loaded.
+
+    pyxnat does not document its interfaces as thread-safe, so each worker thread gets
+    its own copy of `xnat` (the shared interface if None) that reuses its authenticated
+    JSESSION cookie rather than logging in again. If the interface cannot be copied
+    this way, subjects are fetched one at a time on it instead. Returned subjects use
+    `xnat` for any later requests."""
+    import requests
+
+    subject_labels = list(subject_labels)
+    intf = _get_interface() if xnat is None else xnat
+    if not isinstance(getattr(intf, '_http', None), requests.Session):
+        max_workers = 1
+
+    local = threading.local()
+    worker_sessions = []
+    lock = threading.Lock()
+
+    def fetch(label):
+        if max_workers == 1:
+            worker = intf
+        else:
+            if not hasattr(local, 'xnat'):
+                local.xnat = _session_copy(intf)
+                with lock:
+                    worker_sessions.append(local.xnat._http)
+            worker = local.xnat
+        subject = XnatSubject(label, database=database, xnat=worker, evaluate=False)
         try:
-            d = self.log['unusable_scans']
-            s = '\n\t'.join('{}, {}'.format(str(a), str(b)) for a, b 
-                             in d[['ID', 'scan_type']].tolist())
-            print('Unflagged unusable scans:\n\t{}'.format(s))
-        except:
-            print('Unflagged unusable scans: None')
\ No newline at end of file
+            subject.get_metadata()
+        except ValueError as e:
+            return label, None, e
+        subject.interface = xnat
+        return label, subject, None
+
+    # Make sure the interface holds a JSESSION before workers copy it
+    if max_workers > 1 and 'JSESSIONID' not in intf._http.cookies:
+        intf._exec('/data/JSESSION')
+
+    subjects, errors = {}, {}
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for label, subject, error in executor.map(fetch, subject_labels):
+                if error is None:
+                    subjects[label] = subject
+                else:
+                    errors[label] = error
+    finally:
+        # Close the worker connections only; logging them out would end the shared JSESSION
+        for session in worker_sessions:
+            session.close()
+
+    return subjects, errors
+
+
+def _session_copy(xnat):
+    """Return a copy of a requests-based pyxnat interface with its own HTTP session that
+    authenticates with the original's JSESSION cookie instead of logging in."""
+    import requests
+
+    session = requests.Session()
+    session.cookies.update(xnat._http.cookies)
+    session.headers.update(xnat._http.headers)
+    session.verify = xnat._http.verify
+    session.proxies = xnat._http.proxies
+
+    worker = copy.copy(xnat)
+    worker._http = session
+    return worker
+
+
+def enable_cache(xnat, expire_after=3600, cache_name='xnat_cache'):
+    """Serve repeated GET requests made through an XNAT interface from a local sqlite
+    cache. Requires `requests-cache` >= 1.0 and a pyxnat release built on `requests`
+    (current releases are); interfaces using any other transport raise ValueError."""
+    import requests
+    import requests_cache
+
+    session = getattr(xnat, '_http', None)
+    if not isinstance(session, requests.Session):
+        raise ValueError('This XNAT interface does not use a requests session and cannot be cached.')
+    if isinstance(session, requests_cache.CachedSession):
+        return session
+
+    # Carry the authenticated session state over to the cached session
+    cached = requests_cache.CachedSession(cache_name, backend='sqlite',
+                                          expire_after=expire_after,
+                                          allowable_methods=('GET',))
+    cached.auth = session.auth
+    cached.cookies.update(session.cookies)
+    cached.headers.update(session.headers)
+    cached.verify = session.verify
+    cached.proxies = session.proxies
+    xnat._http = cached
+    return cached
+
+
+def clear_cache(xnat):
+    "Empty the request cache of an XNAT interface, if `enable_cache` was called on it."
+    cache = getattr(getattr(xnat, '_http', None), 'cache', None)
+    if hasattr(cache, 'clear'):
+        cache.clear()
+
+
+def _invalidate_cache(xnat, url_fragment):
+    "Drop cached responses whose URL contains url_fragment, if `enable_cache` was called."
+    cache = getattr(getattr(xnat, '_http', None), 'cache', None)
+    if not hasattr(cache, 'filter'):
+        return
+
+    keys = [r.cache_key for r in cache.filter() if url_fragment in r.url]
+    if keys:
+        cache.delete(*keys)